@@ -1,18 +1,131 @@
 """Advanced examples showing the power of the Templite template engine."""
 
+import re
 import sys
-import os
-sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+import textwrap
+from pathlib import Path
+_SRC = str(Path(__file__).resolve().parent.parent / 'src')
+if _SRC not in sys.path:
+    sys.path.insert(0, _SRC)
 
 from templite import Templite
-import json
 
 
-def example_blog_post():
-    """Generate a blog post with comments."""
-    print("=== Blog Post Example ===")
-    
-    template_text = """
+def _render_to_file(template, context, path, buffering=1 << 16):
+    """Render `template` with `context` straight into the file at `path`.
+
+    The output is written in pieces as it's rendered, so the file is opened
+    with a large buffer to keep the writes to disk few.
+    """
+    with open(path, 'w', buffering=buffering) as f:
+        template.render_to(f, context)
+
+
+# One line per match: "# " headings, "## " subheadings, other non-blank
+# text, or a blank line.  Each match also consumes its trailing newline.
+# [^\S\n] is any whitespace but the line break itself, so "\r\n" endings
+# and stray tabs are trimmed the way str.strip() would.
+_MD_RE = re.compile(
+    r'^[^\S\n]*(?:#[ ]([^\S\n]*\S.*?)|##[ ]([^\S\n]*\S.*?)|(.+?))?'
+    r'[^\S\n]*(?:\n|\Z)',
+    re.M,
+)
+
+
+def _md_sub(m):
+    h2, h3, text = m.groups()
+    if h2 is not None:
+        return f'<h2>{h2}</h2>\n'
+    if h3 is not None:
+        return f'<h3>{h3}</h3>\n'
+    if text is not None:
+        return f'<p>{text}</p>\n'
+    return ''
+
+
+# Simple markdown-like filter
+def markdown(text):
+    return _MD_RE.sub(_md_sub, text).rstrip('\n')
+
+
+class Post:
+    def __init__(self, title, author, date, content, tags=None):
+        self.title = title
+        self.author = author
+        self.date = date
+        self.content = content
+        self.tags = tags or []
+
+
+class Comment:
+    def __init__(self, author, date, content):
+        self.author = author
+        self.date = date
+        self.content = content
+
+
+# Bound str.format methods for the per-row report filters.  The methods
+# are made once here, not on every call, but str.format still parses its
+# format string each time it's called.
+currency = "${:,.2f}".format
+percent = "{:.1f}%".format
+
+
+class Product:
+    def __init__(self, name, quantity, revenue, percentage):
+        self.name = name
+        self.quantity = quantity
+        self.revenue = revenue
+        self.percentage = percentage
+
+
+class Region:
+    def __init__(self, name, sales, growth):
+        self.name = name
+        self.sales = sales
+        self.growth = growth
+
+
+# Emails show plain amounts, without the report's thousands separator.
+email_currency = "${:.2f}".format
+
+
+class Recipient:
+    def __init__(self, name, email, username=None):
+        self.name = name
+        self.email = email
+        self.username = username
+
+
+class Order:
+    def __init__(self, number, date, items, total):
+        self.number = number
+        self.date = date
+        self.items = items
+        self.total = total
+
+
+class OrderItem:
+    def __init__(self, name, quantity, total):
+        self.name = name
+        self.quantity = quantity
+        self.total = total
+
+
+class Article:
+    def __init__(self, title, summary, url):
+        self.title = title
+        self.summary = summary
+        self.url = url
+
+
+class Link:
+    def __init__(self, text, url):
+        self.text = text
+        self.url = url
+
+
+_BLOG_POST_TEMPLATE = textwrap.dedent("""
     <!DOCTYPE html>
     <html>
     <head>
@@ -51,7 +164,7 @@ def example_blog_post():
         
         {% if comments %}
             <div class="comments">
-                <h3>Comments ({{comments|length}})</h3>
+                <h3>Comments ({{comments_count}})</h3>
                 {% for comment in comments %}
                     <div class="comment">
                         <div class="comment-author">{{comment.author}}</div>
@@ -63,43 +176,17 @@ def example_blog_post():
         {% endif %}
     </body>
     </html>
-    """
+""").strip()
+
+
+def example_blog_post():
+    """Generate a blog post with comments."""
+    print("=== Blog Post Example ===")
     
-    # Simple markdown-like filter
-    def markdown(text):
-        lines = text.split('\n')
-        result = []
-        for line in lines:
-            line = line.strip()
-            if line.startswith('# '):
-                result.append(f'<h2>{line[2:]}</h2>')
-            elif line.startswith('## '):
-                result.append(f'<h3>{line[3:]}</h3>')
-            elif line:
-                result.append(f'<p>{line}</p>')
-        return '\n'.join(result)
-    
-    def length(items):
-        return len(items)
-    
-    class Post:
-        def __init__(self, title, author, date, content, tags=None):
-            self.title = title
-            self.author = author
-            self.date = date
-            self.content = content
-            self.tags = tags or []
-    
-    class Comment:
-        def __init__(self, author, date, content):
-            self.author = author
-            self.date = date
-            self.content = content
-    
-    template = Templite(template_text, {
-        'markdown': markdown,
-        'length': length
-    })
+    filters = {
+        'markdown': markdown
+    }
+    template = Templite.get_cached(_BLOG_POST_TEMPLATE, filters)
     
     post = Post(
         "Getting Started with Template Engines",
@@ -125,7 +212,9 @@ def example_blog_post():
     
     result = template.render({
         'post': post,
-        'comments': comments
+        'comments': comments,
+        # Known before rendering, so don't make the template compute it.
+        'comments_count': len(comments)
     })
     
     print("Generated blog post HTML (first 500 chars):")
@@ -133,11 +222,7 @@ def example_blog_post():
     print()
 
 
-def example_data_report():
-    """Generate a data report with tables and charts."""
-    print("=== Data Report Example ===")
-    
-    template_text = """
+_DATA_REPORT_TEMPLATE = textwrap.dedent("""
     <html>
     <head>
         <title>{{report_title}}</title>
@@ -217,31 +302,18 @@ def example_data_report():
         {% endif %}
     </body>
     </html>
-    """
-    
-    def currency(amount):
-        return f"${amount:,.2f}"
-    
-    def percent(value):
-        return f"{value:.1f}%"
-    
-    class Product:
-        def __init__(self, name, quantity, revenue, percentage):
-            self.name = name
-            self.quantity = quantity
-            self.revenue = revenue
-            self.percentage = percentage
-    
-    class Region:
-        def __init__(self, name, sales, growth):
-            self.name = name
-            self.sales = sales
-            self.growth = growth
+""").strip()
+
+
+def example_data_report():
+    """Generate a data report with tables and charts."""
+    print("=== Data Report Example ===")
     
-    template = Templite(template_text, {
+    filters = {
         'currency': currency,
         'percent': percent
-    })
+    }
+    template = Templite.get_cached(_DATA_REPORT_TEMPLATE, filters)
     
     products = [
         Product("Widget A", 150, 15000, 35.2),
@@ -265,22 +337,15 @@ def example_data_report():
         'regions': regions
     }
     
-    result = template.render(context)
-    
     # Save report
-    output_file = os.path.join(os.path.dirname(__file__), 'sales_report.html')
-    with open(output_file, 'w') as f:
-        f.write(result)
+    output_file = Path(__file__).parent / 'sales_report.html'
+    _render_to_file(template, context, output_file, buffering=1 << 20)
     
     print(f"Generated sales report saved as '{output_file}'")
     print()
 
 
-def example_email_template():
-    """Generate personalized email templates."""
-    print("=== Email Template Example ===")
-    
-    template_text = """
+_EMAIL_TEMPLATE = textwrap.dedent("""
     Subject: {{subject}}
     
     Dear {{recipient.name|title}},
@@ -334,45 +399,18 @@ def example_email_template():
     
     Best regards,
     The {{company_name}} Team
-    """
+""").strip()
+
+
+def example_email_template():
+    """Generate personalized email templates."""
+    print("=== Email Template Example ===")
     
-    def currency(amount):
-        return f"${amount:.2f}"
-    
-    class Recipient:
-        def __init__(self, name, email, username=None):
-            self.name = name
-            self.email = email
-            self.username = username
-    
-    class Order:
-        def __init__(self, number, date, items, total):
-            self.number = number
-            self.date = date
-            self.items = items
-            self.total = total
-    
-    class OrderItem:
-        def __init__(self, name, quantity, total):
-            self.name = name
-            self.quantity = quantity
-            self.total = total
-    
-    class Article:
-        def __init__(self, title, summary, url):
-            self.title = title
-            self.summary = summary
-            self.url = url
-    
-    class Link:
-        def __init__(self, text, url):
-            self.text = text
-            self.url = url
-    
-    template = Templite(template_text, {
-        'currency': currency,
+    filters = {
+        'currency': email_currency,
         'title': str.title
-    })
+    }
+    template = Templite.get_cached(_EMAIL_TEMPLATE, filters)
     
     # Welcome email
     recipient1 = Recipient("john smith", "john@example.com", "johnsmith123")
@@ -426,54 +464,28 @@ def example_email_template():
     print("-" * 50)
 
 
-def example_code_generator():
-    """Use templates to generate code."""
-    print("=== Code Generator Example ===")
-    
-    class_template = """
-    class {{class_name}}:
-        \"\"\"{{class_description}}\"\"\"
-        
-        def __init__(self{% for field in fields %}, {{field.name}}{% endfor %}):
-            \"\"\"Initialize {{class_name}}.\"\"\"
-            {% for field in fields %}
-            self.{{field.name}} = {{field.name}}
-            {% endfor %}
-        
-        {% for field in fields %}
-        {% if field.type == 'str' %}
-        def get_{{field.name}}(self):
-            \"\"\"Get {{field.name}}.\"\"\"
-            return self.{{field.name}}
-        
-        def set_{{field.name}}(self, value):
-            \"\"\"Set {{field.name}}.\"\"\"
-            if not isinstance(value, str):
-                raise TypeError("{{field.name}} must be a string")
-            self.{{field.name}} = value
-        
-        {% endif %}
-        {% endfor %}
-        def __str__(self):
-            return f"{{class_name}}({% for field in fields %}{{field.name}}={{self.{{field.name}}!r}}{% if not loop.last %}, {% endif %}{% endfor %})"
-        
-        def __repr__(self):
-            return self.__str__()
-    """
-    
-    # Note: This is a simplified version since we don't have loop.last
-    simple_class_template = """
+class Field:
+    def __init__(self, name, type_name):
+        self.name = name
+        self.type = type_name
+
+
+_CLASS_TEMPLATE = Templite("""
 class {{class_name}}:
     \"\"\"{{class_description}}\"\"\"
     
+    __slots__ = ({% for field in fields %}"{{field.name}}", {% endfor %})
+    
     def __init__(self{% for field in fields %}, {{field.name}}{% endfor %}):
         \"\"\"Initialize {{class_name}}.\"\"\"
-        {% for field in fields %}
-        self.{{field.name}} = {{field.name}}
-        {% endfor %}
+        ({% for field in fields %}self.{{field.name}}, {% endfor %}) = ({% for field in fields %}{{field.name}}, {% endfor %})
     
     def __str__(self):
-        fields = [{% for field in fields %}"{{field.name}}={self.{{field.name}}!r}"{% endfor %}]
+        fields = [
+            {% for field in fields %}
+            f"{{field.name}}={self.{{field.name}}!r}",
+            {% endfor %}
+        ]
         return f"{{class_name}}({', '.join(fields)})"
     
     def to_dict(self):
@@ -483,14 +495,12 @@ class {{class_name}}:
             "{{field.name}}": self.{{field.name}},
             {% endfor %}
         }
-    """
-    
-    class Field:
-        def __init__(self, name, type_name):
-            self.name = name
-            self.type = type_name
-    
-    template = Templite(simple_class_template)
+""")
+
+
+def example_code_generator():
+    """Use templates to generate code."""
+    print("=== Code Generator Example ===")
     
     # Generate a Person class
     person_context = {
@@ -503,14 +513,13 @@ class {{class_name}}:
         ]
     }
     
-    person_code = template.render(person_context)
+    person_code = _CLASS_TEMPLATE.render(person_context)
     
     print("Generated Person class:")
     print(person_code)
     
     # Save generated code
-    with open(os.path.join(os.path.dirname(__file__), 'generated_person.py'), 'w') as f:
-        f.write(person_code)
+    (Path(__file__).parent / 'generated_person.py').write_text(person_code)
     
     print("Generated code saved as 'generated_person.py'")
 
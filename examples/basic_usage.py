@@ -1,16 +1,58 @@
 """Basic usage examples for the Templite template engine."""
 
 import sys
-import os
-sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+import textwrap
+from pathlib import Path
+_SRC = str(Path(__file__).resolve().parent.parent / 'src')
+if _SRC not in sys.path:
+    sys.path.insert(0, _SRC)
 
 from templite import Templite
 
 
+def upper(text):
+    return text.upper()
+
+
+def add_exclamation(text):
+    return text + "!!!"
+
+
+def currency(price):
+    return f"${float(price):.2f}"
+
+
+def truncate(text, length=50):
+    return text[:length] + "..." if len(text) > length else text
+
+
+# A bound str.format method, so each call skips the f-string bytecode.
+format_price = "${:.2f}".format
+
+
+class Item:
+    def __init__(self, name, price):
+        self.name = name
+        self.price = price
+
+
+class User:
+    def __init__(self, name, is_premium=False):
+        self.name = name
+        self.is_premium = is_premium
+
+
+class Product:
+    def __init__(self, name, price, description=""):
+        self.name = name
+        self.price = price
+        self.description = description
+
+
 def example_basic():
     """Basic variable substitution."""
     print("=== Basic Example ===")
-    template = Templite("Hello, {{name}}!")
+    template = Templite.get_cached("Hello, {{name}}!")
     result = template.render({'name': 'World'})
     print(f"Template: Hello, {{{{name}}}}!")
     print(f"Result: {result}")
@@ -21,16 +63,8 @@ def example_with_filters():
     """Example using filters."""
     print("=== Filter Example ===")
     
-    def upper(text):
-        return text.upper()
-    
-    def add_exclamation(text):
-        return text + "!!!"
-    
-    template = Templite(
-        "{{greeting|upper|add_exclamation}}",
-        {'upper': upper, 'add_exclamation': add_exclamation}
-    )
+    filters = {'upper': upper, 'add_exclamation': add_exclamation}
+    template = Templite.get_cached("{{greeting|upper|add_exclamation}}", filters)
     
     result = template.render({'greeting': 'hello world'})
     print("Template: {{greeting|upper|add_exclamation}}")
@@ -38,20 +72,21 @@ def example_with_filters():
     print()
 
 
-def example_conditionals():
-    """Example using conditionals."""
-    print("=== Conditional Example ===")
-    
-    template_text = """
+_CONDITIONALS_TEMPLATE = textwrap.dedent("""
     {% if user_logged_in %}
         Welcome back, {{username}}!
     {% endif %}
     {% if show_login %}
         Please log in.
     {% endif %}
-    """.strip()
+""").strip()
+
+
+def example_conditionals():
+    """Example using conditionals."""
+    print("=== Conditional Example ===")
     
-    template = Templite(template_text)
+    template = Templite.get_cached(_CONDITIONALS_TEMPLATE)
     
     # User logged in
     result1 = template.render({
@@ -74,25 +109,21 @@ def example_conditionals():
     print()
 
 
-def example_loops():
-    """Example using loops."""
-    print("=== Loop Example ===")
-    
-    template_text = """
+_LOOPS_TEMPLATE = textwrap.dedent("""
     <h2>Shopping List:</h2>
     <ul>
     {% for item in items %}
         <li>{{item.name}} - ${{item.price}}</li>
     {% endfor %}
     </ul>
-    """.strip()
-    
-    class Item:
-        def __init__(self, name, price):
-            self.name = name
-            self.price = price
+""").strip()
+
+
+def example_loops():
+    """Example using loops."""
+    print("=== Loop Example ===")
     
-    template = Templite(template_text)
+    template = Templite.get_cached(_LOOPS_TEMPLATE)
     
     items = [
         Item("Apple", "1.00"),
@@ -106,11 +137,7 @@ def example_loops():
     print()
 
 
-def example_complex():
-    """Complex example combining all features."""
-    print("=== Complex Example ===")
-    
-    template_text = """
+_COMPLEX_TEMPLATE = textwrap.dedent("""
     <html>
     <head>
         <title>{{page_title}}</title>
@@ -140,33 +167,20 @@ def example_complex():
         </footer>
     </body>
     </html>
-    """.strip()
-    
-    # Define helper functions
-    def currency(price):
-        return f"${float(price):.2f}"
-    
-    def truncate(text, length=50):
-        return text[:length] + "..." if len(text) > length else text
-    
-    # Define data classes
-    class User:
-        def __init__(self, name, is_premium=False):
-            self.name = name
-            self.is_premium = is_premium
-    
-    class Product:
-        def __init__(self, name, price, description):
-            self.name = name
-            self.price = price
-            self.description = description
+""").strip()
+
+
+def example_complex():
+    """Complex example combining all features."""
+    print("=== Complex Example ===")
     
     # Create template with helper functions
-    template = Templite(template_text, {
+    filters = {
         'title': str.title,
         'currency': currency,
         'truncate': truncate
-    })
+    }
+    template = Templite.get_cached(_COMPLEX_TEMPLATE, filters)
     
     # Prepare data
     user = User("john doe", True)
@@ -189,11 +203,7 @@ def example_complex():
     print()
 
 
-def example_web_page():
-    """Example of generating a complete web page."""
-    print("=== Web Page Example ===")
-    
-    template_text = """
+_WEB_PAGE_TEMPLATE = textwrap.dedent("""
     <!DOCTYPE html>
     <html>
     <head>
@@ -221,17 +231,15 @@ def example_web_page():
         {% endfor %}
     </body>
     </html>
-    """.strip()
-    
-    def format_price(price):
-        return f"${price:.2f}"
-    
-    class Product:
-        def __init__(self, name, price):
-            self.name = name
-            self.price = price
+""").strip()
+
+
+def example_web_page():
+    """Example of generating a complete web page."""
+    print("=== Web Page Example ===")
     
-    template = Templite(template_text, {'format_price': format_price})
+    filters = {'format_price': format_price}
+    template = Templite.get_cached(_WEB_PAGE_TEMPLATE, filters)
     
     context = {
         'title': 'Product Catalog',
@@ -246,8 +254,7 @@ def example_web_page():
     result = template.render(context)
     
     # Write to file
-    with open(os.path.join(os.path.dirname(__file__), 'output.html'), 'w') as f:
-        f.write(result)
+    (Path(__file__).parent / 'output.html').write_text(result)
     
     print("Generated web page saved as 'output.html'")
     print("First few lines of the result:")
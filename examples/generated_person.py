@@ -2,18 +2,22 @@
 class Person:
     """Represents a person with basic information."""
     
+    __slots__ = ("name", "age", "email", )
+    
     def __init__(self, name, age, email):
         """Initialize Person."""
-        
-        self.name = name
-        
-        self.age = age
-        
-        self.email = email
-        
+        (self.name, self.age, self.email, ) = (name, age, email, )
     
     def __str__(self):
-        fields = ["name={self.name!r}""age={self.age!r}""email={self.email!r}"]
+        fields = [
+            
+            f"name={self.name!r}",
+            
+            f"age={self.age!r}",
+            
+            f"email={self.email!r}",
+            
+        ]
         return f"Person({', '.join(fields)})"
     
     def to_dict(self):
@@ -27,4 +31,3 @@ class Person:
             "email": self.email,
             
         }
-    
\ No newline at end of file
@@ -1,9 +1,11 @@
 """Performance comparison and benchmarking for Templite."""
 
 import sys
-import os
 import time
-sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+from pathlib import Path
+_SRC = str(Path(__file__).resolve().parent.parent / 'src')
+if _SRC not in sys.path:
+    sys.path.insert(0, _SRC)
 
 from templite import Templite
 
@@ -94,8 +96,7 @@ def compare_with_format_string():
     
     # Benchmark template
     start_time = time.time()
-    for _ in range(num_iterations):
-        result1 = template.render(context)
+    result1 = template.render_many([context] * num_iterations)[-1]
     template_time = time.time() - start_time
     
     # Benchmark string format
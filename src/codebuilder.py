@@ -1,21 +1,201 @@
 """CodeBuilder class for generating Python code with proper indentation."""
 
+import functools
+import hashlib
+import importlib.machinery
+import importlib.util
+import marshal
+import os
+import sys
+import types
+
+# Released CodeBuilders, kept for reuse by CodeBuilder.acquire.
+_POOL = []
+_POOL_SIZE = 64
+
+# String constants of compiled code, so that equal strings in different
+# templates' code are one object.  Only strings of at most
+# _CONSTANTS_MAX_LEN characters are shared, and it stops growing at
+# _CONSTANTS_SIZE, so it holds at most a few megabytes.
+_CONSTANTS = {}
+_CONSTANTS_SIZE = 10000
+_CONSTANTS_MAX_LEN = 256
+
+# Where the mypyc backend keeps its compiled extensions between runs.
+MYPYC_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "templite")
+
+
+@functools.lru_cache(maxsize=256)
+def _compile_source(python_source):
+    """Compile `python_source`, reusing the code object for repeated source."""
+    return _share_constants(compile(python_source, "<templite>", "exec"))
+
+
+@functools.lru_cache(maxsize=256)
+def _load_cached_code(python_source, cache_dir):
+    """Get the code object for `python_source` from `cache_dir`.
+
+    The code is marshalled into a file named by a hash of the source and
+    the bytecode magic number, so it's only compiled once across processes,
+    and never read by a different Python version.  Unreadable files are
+    compiled again and rewritten.  If the file can't be written, the code
+    is still returned, only not cached.
+    """
+    source_bytes = python_source.encode("utf-8")
+    digest = hashlib.sha1(importlib.util.MAGIC_NUMBER + source_bytes).hexdigest()
+    path = os.path.join(cache_dir, digest + ".mpy")
+    try:
+        with open(path, "rb") as f:
+            return _share_constants(marshal.load(f))
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+
+    code = _compile_source(python_source)
+    # Write to a temporary file first, so no one reads a partial file.
+    temp_path = "%s.%d.tmp" % (path, os.getpid())
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(temp_path, "wb") as f:
+            marshal.dump(code, f)
+        os.replace(temp_path, path)
+    except OSError:
+        # The cache can't be written: the code works just as well without.
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+    return code
+
+
+def _share_constants(code):
+    """Return `code` with its string constants replaced by shared ones.
+
+    Nested code objects, for functions and comprehensions, are done too.
+    Before Python 3.8, code objects can't be changed, so `code` is returned
+    as it is.
+    """
+    if not hasattr(code, "replace"):
+        return code
+    consts = []
+    for const in code.co_consts:
+        if type(const) is str and len(const) <= _CONSTANTS_MAX_LEN:
+            shared = _CONSTANTS.get(const)
+            if shared is None:
+                if len(_CONSTANTS) < _CONSTANTS_SIZE:
+                    _CONSTANTS[const] = const
+            else:
+                const = shared
+        elif isinstance(const, types.CodeType):
+            const = _share_constants(const)
+        consts.append(const)
+    return code.replace(co_consts=tuple(consts))
+
+
+def _load_mypyc_module(python_source):
+    """Compile `python_source` with mypyc, and import it as a module.
+
+    Extensions are cached in MYPYC_CACHE_DIR by a hash of the source, so a
+    given source is only compiled once, even across processes.
+    """
+    # mypyc is optional: only needed if someone asks for this backend.
+    from mypyc.build import mypycify
+    from setuptools import Distribution
+
+    digest = hashlib.sha256(python_source.encode("utf-8")).hexdigest()[:20]
+    name = "templite_" + digest
+    if name in sys.modules:
+        return sys.modules[name]
+
+    build_dir = os.path.join(MYPYC_CACHE_DIR, name)
+    ext_path = os.path.join(
+        build_dir, name + importlib.machinery.EXTENSION_SUFFIXES[0]
+    )
+    if not os.path.exists(ext_path):
+        os.makedirs(build_dir, exist_ok=True)
+        source_path = os.path.join(build_dir, name + ".py")
+        with open(source_path, "w") as f:
+            f.write(python_source)
+        # Every path is given explicitly, so all the build files go under
+        # build_dir, without changing the current directory.
+        dist = Distribution({
+            "name": name,
+            "ext_modules": mypycify(
+                [
+                    "--cache-dir", os.path.join(build_dir, ".mypy_cache"),
+                    source_path,
+                ],
+                target_dir=os.path.join(build_dir, "build"),
+            ),
+        })
+        build_ext = dist.get_command_obj("build_ext")
+        build_ext.build_lib = build_dir
+        build_ext.build_temp = os.path.join(build_dir, "temp")
+        dist.run_command("build_ext")
+
+    spec = importlib.util.spec_from_file_location(name, ext_path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
 
 class CodeBuilder:
     """Build source code conveniently."""
 
+    __slots__ = ('_buf', '_sections', 'indent_level')
+
     INDENT_STEP = 4  # PEP8 says so!
 
+    # Indentation prefixes indexed by width, for up to 32 levels.
+    _INDENTS = tuple(" " * n for n in range(32 * INDENT_STEP))
+
     def __init__(self, indent=0):
-        self.code = []
+        # The UTF-8 source of the lines added here, and (offset, section)
+        # pairs saying where in it each sub-CodeBuilder goes.
+        self._buf = bytearray()
+        self._sections = []
         self.indent_level = indent
 
+    @classmethod
+    def acquire(cls, indent=0):
+        """Get an empty CodeBuilder, reusing a released one if possible."""
+        if _POOL:
+            builder = _POOL.pop()
+            builder.indent_level = indent
+            return builder
+        return cls(indent)
+
+    def release(self):
+        """Return this CodeBuilder, and all its sections, to the pool.
+
+        None of them should be used after this.
+        """
+        seen = set()
+        pending = [self]
+        while pending:
+            builder = pending.pop()
+            if id(builder) in seen:
+                # A section added in more than one place.
+                continue
+            seen.add(id(builder))
+            for _, section in builder._sections:
+                pending.append(section)
+            builder._buf.clear()
+            builder._sections.clear()
+            if len(_POOL) < _POOL_SIZE:
+                _POOL.append(builder)
+
     def add_line(self, line):
         """Add a line of source to the code.
 
         Indentation and newline will be added for you, don't provide them.
         """
-        self.code.extend([" " * self.indent_level, line, "\n"])
+        level = self.indent_level
+        if 0 <= level < len(self._INDENTS):
+            indent = self._INDENTS[level]
+        else:
+            indent = " " * level
+        self._buf += (indent + line + "\n").encode("utf-8")
 
     def indent(self):
         """Increase the current indent for following lines."""
@@ -25,23 +205,77 @@ class CodeBuilder:
         """Decrease the current indent for following lines."""
         self.indent_level -= self.INDENT_STEP
 
-    def add_section(self):
-        """Add a section, a sub-CodeBuilder."""
-        section = CodeBuilder(self.indent_level)
-        self.code.append(section)
+    def add_section(self, section=None):
+        """Add a section, a sub-CodeBuilder.
+
+        A new section is made unless `section` is given, in which case that
+        existing CodeBuilder is added, so the same code can appear in more
+        than one place.
+        """
+        if section is None:
+            section = CodeBuilder.acquire(self.indent_level)
+        self._sections.append((len(self._buf), section))
         return section
 
+    def _flatten(self, out):
+        """Append the source of this code, and all its sections, to `out`.
+
+        The pieces are views of the builders' buffers, so nothing is copied
+        until they're joined.
+        """
+        buf = memoryview(self._buf)
+        start = 0
+        for offset, section in self._sections:
+            out.append(buf[start:offset])
+            section._flatten(out)
+            start = offset
+        out.append(buf[start:])
+
     def __str__(self):
         """Convert the code to a string."""
-        return "".join(str(c) for c in self.code)
-
-    def get_globals(self):
-        """Execute the code, and return a dict of globals it defines."""
-        # A check that the caller really finished all the blocks they started.
-        assert self.indent_level == 0
-        # Get the Python source as a single string.
-        python_source = str(self)
-        # Execute the source, defining globals, and return them.
-        global_namespace = {}
-        exec(python_source, global_namespace)
+        out = []
+        self._flatten(out)
+        return b"".join(out).decode("utf-8")
+
+    def _check_finished(self):
+        """Check that the caller really finished all the blocks they started.
+
+        Like an assert, this is compiled away when running with -O.
+        """
+        if __debug__ and self.indent_level != 0:
+            raise RuntimeError(
+                "Unbalanced indentation: indent level is %d, not 0"
+                % self.indent_level
+            )
+
+    def get_code(self, cache_dir=None):
+        """Compile the code, and return the code object.
+
+        The code object can be run with exec as many times as needed, and
+        is shared by CodeBuilders that produce the same source.  If
+        `cache_dir` is given, compiled code is kept in files there, and
+        reused by later processes.
+        """
+        self._check_finished()
+        if cache_dir is not None:
+            return _load_cached_code(str(self), os.fspath(cache_dir))
+        return _compile_source(str(self))
+
+    def get_globals(self, backend="python", cache_dir=None, namespace=None):
+        """Execute the code, and return a dict of globals it defines.
+
+        With `backend="mypyc"`, the code is compiled to a C extension with
+        mypyc (which must be installed) instead of being run by exec.
+        `cache_dir` is passed to `get_code` for the python backend, and
+        `namespace`, if given, is the dict of globals it's run in, so the
+        code can use values that are already there.
+        """
+        if backend not in ("python", "mypyc"):
+            raise ValueError("Unknown backend: %r" % (backend,))
+        if backend == "mypyc":
+            self._check_finished()
+            return dict(vars(_load_mypyc_module(str(self))))
+        # Execute the code, defining globals, and return them.
+        global_namespace = {} if namespace is None else namespace
+        exec(self.get_code(cache_dir), global_namespace)
         return global_namespace
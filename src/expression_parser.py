@@ -4,149 +4,345 @@ An advanced expression parser for the Templite template engine.
 This implementation uses a Pratt parser to handle operator precedence.
 """
 
+import ast
+import functools
+import keyword
+import math
+import operator
 import re
+import sys
+
+# Handle both package imports and direct imports
+try:
+    from .exceptions import TempliteSyntaxError
+except ImportError:
+    from exceptions import TempliteSyntaxError
+
+_TOKEN_SPEC = [
+    ('NUMBER',   r'\d+(?:\.\d*)?'),
+    ('STRING',   r'"[^"]*"'),
+    ('LOGIC',    r'\b(?:and|or|not)\b'),
+    ('ID',       r'[_a-zA-Z][_a-zA-Z0-9]*'),
+    ('LPAREN',   r'\('),
+    ('RPAREN',   r'\)'),
+    ('LBRACKET', r'\['),
+    ('RBRACKET', r'\]'),
+    ('COMMA',    r','),
+    ('DOT',      r'\.'),
+    ('COMP',     r'==|!=|<=|>=|<|>'),
+    ('OP',       r'[+\-*/%]'),
+    ('SKIP',     r'[ \t]+'),
+    ('PIPE',     r'\|'),
+    ('MISMATCH', r'.'),
+]
+# Each kind is the only capturing group in its alternative, so a match's
+# `lastindex` is the group holding the token text.
+_TOKEN_RE = re.compile('|'.join('(?P<%s>%s)' % pair for pair in _TOKEN_SPEC))
+
+# Binding powers by token value; anything else binds at 0.
+_BP = {
+    '.': 80,
+    'not': 70,
+    '|': 60,
+    '*': 50, '/': 50, '%': 50,
+    '+': 40, '-': 40,
+    '==': 30, '!=': 30, '<': 30, '<=': 30, '>': 30, '>=': 30,
+    'and': 20,
+    'or': 10,
+}
+
+# Operators that are evaluated at parse time when both operands are literals.
+_FOLD_OPS = {
+    '+': operator.add, '-': operator.sub,
+    '*': operator.mul, '/': operator.truediv, '%': operator.mod,
+    '==': operator.eq, '!=': operator.ne,
+    '<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge,
+    'and': lambda a, b: a and b,
+    'or': lambda a, b: a or b,
+}
+
+# Folded strings longer than this (or ints with more bits) are left to be
+# computed at render time.
+_FOLD_MAX_LEN = 4096
+
+
+def _fold(op, a, b):
+    """Return `a op b` as a ('lit', value) node, or None if it can't be folded."""
+    if op == '*' and isinstance(a, str) != isinstance(b, str):
+        # Don't build a huge string just to find out it's too huge.
+        count = b if isinstance(a, str) else a
+        text = a if isinstance(a, str) else b
+        if isinstance(count, int) and len(text) * count > _FOLD_MAX_LEN:
+            return None
+    try:
+        value = _FOLD_OPS[op](a, b)
+    except Exception:
+        # Let the error happen at render time, as it always has.
+        return None
+    return _literal(value)
+
+
+def _literal(value):
+    """Make a ('lit', value) node, or None if `value` shouldn't be inlined."""
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    if isinstance(value, str) and len(value) > _FOLD_MAX_LEN:
+        return None
+    if isinstance(value, int) and value.bit_length() > _FOLD_MAX_LEN:
+        return None
+    return ('lit', value)
+
+
+# Python names for template names, so each is only built once.
+_CNAMES = {}
+
+
+def _cname(name):
+    """Return the interned Python name, c_<name>, for the template `name`."""
+    cname = _CNAMES.get(name)
+    if cname is None:
+        cname = _CNAMES[name] = sys.intern("c_" + name)
+    return cname
+
+
+def _code(node):
+    """Return the Python code for a parsed node."""
+    kind, value = node
+    if kind == 'lit':
+        return repr(value)
+    elif kind == 'list':
+        return "[%s]" % ", ".join(map(_code, value))
+    return value
+
+
+@functools.lru_cache(maxsize=1024)
+def _parse_cached(text):
+    """Parse `text`, returning its code, names, dots, calls, and items.
+
+    `names` are the names it uses, and `calls` the ones that are called, as
+    filters or functions.  `dots` are the attribute names that have a
+    `_dot_<name>` helper call in the code.  `items` is a tuple of the code
+    for each element if `text` is a list display like `[a, "b"]`, otherwise
+    None.
+
+    Nothing here depends on the Templite being compiled, so templates that
+    share an expression share this work.
+    """
+    parser = ExpressionParser(text, None)
+    node = parser._parse()
+    items = None
+    if node[0] == 'list':
+        items = tuple(map(_code, node[1]))
+    # Each name only needs registering once.
+    names = tuple(dict.fromkeys(parser.names))
+    dots = frozenset(parser.dots)
+    calls = frozenset(parser.calls)
+    return _code(node), names, dots, calls, items
+
 
 class ExpressionParser:
     """
     Parses complex expressions with operator precedence, comparisons, and logic.
     """
+    __slots__ = (
+        'text', 'templite', 'names', 'dots', 'calls', 'items',
+        'kinds', 'values', 'bps', 'pos',
+    )
+
     def __init__(self, text, templite):
+        self.text = text
         self.templite = templite
-        self.tokens = self._tokenize(text)
+        # Names the expression reads, in order, to register with templite.
+        self.names = []
+        # Attribute names used with dots, to register with templite.
+        self.dots = set()
+        # Names called as filters or functions.
+        self.calls = set()
+        # If the expression is a list display, the code for each element.
+        self.items = None
+        # The tokens, as parallel lists of kinds, values and binding powers.
+        self.kinds = None
+        self.values = None
+        self.bps = None
         self.pos = 0
 
     def _tokenize(self, text):
-        token_specification = [
-            ('NUMBER',   r'\d+(\.\d*)?'),
-            ('STRING',   r'"[^"]*"'),
-            ('LOGIC',    r'\b(and|or|not)\b'),
-            ('ID',       r'[_a-zA-Z][_a-zA-Z0-9]*'),
-            ('LPAREN',   r'\('),
-            ('RPAREN',   r'\)'),
-            ('DOT',      r'\.'),
-            ('COMP',     r'==|!=|<=|>=|<|>'),
-            ('OP',       r'[+\-*/%]'),
-            ('SKIP',     r'[ \t]+'),
-            ('PIPE',     r'\|'),
-            ('MISMATCH', r'.'),
-        ]
-        tok_regex = '|'.join('(?P<%s>%s)' % pair for pair in token_specification)
-        tokens = []
-        for mo in re.finditer(tok_regex, text):
+        """Split `text` into tokens, returning lists of kinds, values and bps."""
+        kinds = []
+        values = []
+        bps = []
+        for mo in _TOKEN_RE.finditer(text):
             kind = mo.lastgroup
-            value = mo.group()
             if kind == 'SKIP':
                 continue
-            elif kind == 'MISMATCH':
+            value = mo.group(mo.lastindex)
+            if kind == 'MISMATCH':
                 raise ValueError(f"Unexpected character: {value}")
-            tokens.append((kind, value))
-        tokens.append(('EOF', 'EOF'))
-        return tokens
+            kinds.append(kind)
+            values.append(value)
+            bps.append(_BP.get(value, 0))
+        kinds.append('EOF')
+        values.append('EOF')
+        bps.append(0)
+        return kinds, values, bps
 
     def parse(self):
+        """Return the Python code for the expression.
+
+        Each name the expression uses is registered as a variable of the
+        templite, each dotted attribute name in its `all_dots`, and each called
+        name in its `all_calls`, whether or not the parse came from the cache.
+        """
+        code, names, dots, calls, self.items = _parse_cached(self.text)
+        self.names.extend(names)
+        self.dots.update(dots)
+        self.calls.update(calls)
+        templite = self.templite
+        templite.all_dots.update(dots)
+        templite.all_calls.update(calls)
+        variable = templite._variable
+        all_vars = templite.all_vars
+        for name in names:
+            variable(name, all_vars)
+        return code
+
+    def _parse(self):
+        self.kinds, self.values, self.bps = self._tokenize(self.text)
         expr = self.parse_expression(0)
         self.match('EOF')
         return expr
 
     def parse_expression(self, rbp):
+        """Parse an expression, returning a node.
+
+        Nodes are ('lit', value) for constants, ('list', nodes) for list
+        displays, and ('expr', code) for everything else.
+        """
         left = self.nud()
-        while rbp < self.current_token_bp():
+        bps = self.bps
+        while rbp < bps[self.pos]:
             left = self.led(left)
         return left
 
     def nud(self):
         """Null denotation: for prefixes and atoms."""
-        token_kind, token_value = self.peek()
-        self.advance()
+        pos = self.pos
+        self.pos = pos + 1
+        handler = self._NUD.get(self.kinds[pos], ExpressionParser._nud_invalid)
+        return handler(self, self.values[pos])
+
+    def _nud_literal(self, token_value):
+        return ('lit', ast.literal_eval(token_value))
+
+    def _nud_id(self, token_value):
+        if self.kinds[self.pos] == 'LPAREN':
+            return self.handle_function_call(token_value)
+
+        self.names.append(token_value)
+        return ('expr', _cname(token_value))
+
+    def _nud_lparen(self, token_value):
+        expr = self.parse_expression(0)
+        self.match('RPAREN')
+        if expr[0] != 'expr':
+            return expr
+        return ('expr', f"({expr[1]})")
+
+    def _nud_logic(self, token_value):
+        if token_value != 'not':
+            return self._nud_invalid(token_value)
+        expr = self.parse_expression(70)
+        if expr[0] == 'lit':
+            return ('lit', not expr[1])
+        return ('expr', f"(not {_code(expr)})")
+
+    def _nud_lbracket(self, token_value):
+        items = []
+        while self.kinds[self.pos] != 'RBRACKET':
+            items.append(self.parse_expression(0))
+            if self.kinds[self.pos] != 'COMMA':
+                break
+            self.pos += 1
+        self.match('RBRACKET')
+        return ('list', tuple(items))
 
-        if token_kind == 'NUMBER':
-            return token_value
-        elif token_kind == 'STRING':
-            return token_value
-        elif token_kind == 'ID':
-            if self.peek()[0] == 'LPAREN':
-                return self.handle_function_call(token_value)
-
-            self.templite._variable(token_value, self.templite.all_vars)
-            code = f"c_{token_value}"
-            return code
-        elif token_kind == 'LPAREN':
-            expr = self.parse_expression(0)
-            self.match('RPAREN')
-            return f"({expr})"
-        elif token_value == 'not':
-            expr = self.parse_expression(70)
-            return f"(not {expr})"
-        else:
-            raise self.templite._syntax_error("Invalid expression start", token_value)
+    def _nud_invalid(self, token_value):
+        raise self._syntax_error("Invalid expression start", token_value)
 
     def led(self, left):
         """Left denotation: for infix and postfix operators."""
-        token_kind, token_value = self.peek()
-
-        if token_kind in ('OP', 'COMP', 'LOGIC'):
-            bp = self.binding_power(token_value)
-            self.advance()
-            right = self.parse_expression(bp)
-            op = token_value
-            return f"({left} {op} {right})"
-        elif token_kind == 'DOT':
-            self.advance()
-            prop = self.peek()[1]
-            self.advance()
-            return f"do_dots({left}, '{prop}')"
-        elif token_kind == 'PIPE':
-            self.advance()
-            filt = self.peek()[1]
-            self.advance()
-            self.templite._variable(filt, self.templite.all_vars)
-            return f"c_{filt}({left})"
-        else:
-            raise self.templite._syntax_error("Invalid operator", token_value)
+        pos = self.pos
+        handler = self._LED.get(self.kinds[pos], ExpressionParser._led_invalid)
+        return handler(self, left, self.values[pos])
+
+    def _led_binary(self, left, op):
+        bp = self.bps[self.pos]
+        self.advance()
+        right = self.parse_expression(bp)
+        if left[0] == 'lit' and right[0] == 'lit':
+            folded = _fold(op, left[1], right[1])
+            if folded is not None:
+                return folded
+        return ('expr', f"({_code(left)} {op} {_code(right)})")
+
+    def _led_dot(self, left, token_value):
+        prop = self.values[self.pos + 1]
+        self.pos += 2
+        if prop.isidentifier() and not keyword.iskeyword(prop):
+            # The templite defines a _dot_<prop> function for this.
+            self.dots.add(prop)
+            return ('expr', f"_dot_{prop}({_code(left)})")
+        return ('expr', f"do_dots({_code(left)}, '{prop}')")
+
+    def _led_pipe(self, left, token_value):
+        filt = self.values[self.pos + 1]
+        self.pos += 2
+        self.names.append(filt)
+        self.calls.add(filt)
+        return ('expr', f"{_cname(filt)}({_code(left)})")
+
+    def _led_invalid(self, left, token_value):
+        raise self._syntax_error("Invalid operator", token_value)
+
+    # Handlers by token kind.  These are plain functions, looked up on the
+    # class and passed `self`, so parsers don't each build bound methods.
+    _NUD = {
+        'NUMBER': _nud_literal,
+        'STRING': _nud_literal,
+        'ID': _nud_id,
+        'LPAREN': _nud_lparen,
+        'LBRACKET': _nud_lbracket,
+        'LOGIC': _nud_logic,
+    }
+    _LED = {
+        'OP': _led_binary,
+        'COMP': _led_binary,
+        'LOGIC': _led_binary,
+        'DOT': _led_dot,
+        'PIPE': _led_pipe,
+    }
 
     def handle_function_call(self, name):
         self.advance()
         args = []
-        while self.peek()[0] != 'RPAREN':
-            args.append(self.parse_expression(0))
-            if self.peek()[0] == ',':
+        while self.kinds[self.pos] != 'RPAREN':
+            args.append(_code(self.parse_expression(0)))
+            if self.kinds[self.pos] == 'COMMA':
                 self.advance()
         self.match('RPAREN')
-        self.templite._variable(name, self.templite.all_vars)
-        return f"c_{name}({', '.join(args)})"
-
-    def current_token_bp(self):
-        _, token_value = self.peek()
-        return self.binding_power(token_value)
-
-    def binding_power(self, op):
-        if op == '.':
-            return 80
-        if op == 'not':
-            return 70
-        if op == '|':
-            return 60
-        if op in ('*', '/', '%'):
-            return 50
-        if op in ('+', '-'):
-            return 40
-        if op in ('==', '!=', '<', '<=', '>', '>='):
-            return 30
-        if op == 'and':
-            return 20
-        if op == 'or':
-            return 10
-        return 0
-
-    def peek(self):
-        return self.tokens[self.pos]
+        self.names.append(name)
+        self.calls.add(name)
+        return ('expr', f"{_cname(name)}({', '.join(args)})")
 
     def advance(self):
         self.pos += 1
-        return self.tokens[self.pos - 1]
+        return (self.kinds[self.pos - 1], self.values[self.pos - 1])
 
     def match(self, expected_kind):
-        token_kind, _ = self.peek()
-        if token_kind == expected_kind:
+        if self.kinds[self.pos] == expected_kind:
             return self.advance()
-        raise self.templite._syntax_error(f"Expected {expected_kind}", self.peek()[1])
\ No newline at end of file
+        raise self._syntax_error(f"Expected {expected_kind}", self.values[self.pos])
+
+    def _syntax_error(self, msg, thing):
+        """Build a syntax error using `msg`, and showing `thing`."""
+        return TempliteSyntaxError("%s: %r" % (msg, thing))
@@ -1,5 +1,8 @@
 """A simple template engine for Python."""
 
+import ast
+import functools
+import math
 import re
 
 # Handle both package imports and direct imports
@@ -13,6 +16,75 @@ except ImportError:
     from expression_parser import ExpressionParser
 
 
+# The tags in a template: {{expressions}}, {% action tags %} and {# comments #}.
+_TOKEN_RE = re.compile(
+    r"(?P<expr>{{.*?}})|(?P<tag>{%.*?%})|(?P<comment>{#.*?#})", re.DOTALL
+)
+
+
+def _tokenize(text):
+    """Split template `text` into (kind, token) pairs.
+
+    `kind` is 'expr', 'tag' or 'comment' for tags, and 'text' for the
+    literal text between them.
+    """
+    pos = 0
+    for match in _TOKEN_RE.finditer(text):
+        start = match.start()
+        if start > pos:
+            yield 'text', text[pos:start]
+        yield match.lastgroup, match.group()
+        pos = match.end()
+    if pos < len(text):
+        yield 'text', text[pos:]
+
+
+# A valid variable name.
+_NAME_RE = re.compile(r"[_a-zA-Z][_a-zA-Z0-9]*$")
+
+# Characters that stop expression code being put in an f-string as it is.
+_FSTRING_UNSAFE_RE = re.compile(r"""['"\\{}!:]""")
+
+
+def _output_code(pieces):
+    """Make the Python code to produce the output for `pieces`.
+
+    `pieces` is a list of ('text', literal) and ('expr', code) pairs.
+    Returns (setup, code): `code` is a single expression, an f-string if
+    there are any expressions, and `setup` is a list of lines to run first.
+
+    If any expression can't be written inside the f-string, all of them are
+    assigned to temporaries in `setup`, so they're still evaluated in order.
+    """
+    exprs = [value for kind, value in pieces if kind == 'expr']
+    if not exprs:
+        return [], repr("".join(value for _, value in pieces))
+
+    setup = []
+    if any(_FSTRING_UNSAFE_RE.search(expr) for expr in exprs):
+        for i, expr in enumerate(exprs):
+            setup.append("_t%d = %s" % (i, expr))
+        exprs = ["_t%d" % i for i in range(len(exprs))]
+
+    fmt = []
+    exprs = iter(exprs)
+    for kind, value in pieces:
+        if kind == 'text':
+            fmt.append(value.replace("{", "{{").replace("}", "}}"))
+        else:
+            fmt.append("{%s!s}" % next(exprs))
+    return setup, "f" + repr("".join(fmt))
+
+
+def _is_literal(code):
+    """Is the Python `code` a literal, with the same value whenever it runs?"""
+    try:
+        ast.literal_eval(code)
+    except (ValueError, SyntaxError):
+        return False
+    return True
+
+
 class Templite:
     """A simple template renderer, for a nano-subset of Django syntax.
     
@@ -31,11 +103,18 @@ class Templite:
     {# ... #} - comments (ignored)
     """
 
-    def __init__(self, text, *contexts):
+    # Loops over list displays with at most this many items are unrolled.
+    UNROLL_LIMIT = 16
+
+    def __init__(self, text, *contexts, backend="python", cache_dir=None):
         """Construct a Templite with the given `text`.
 
         `contexts` are dictionaries of values to use for future renderings.
         These are good for filters and global values.
+
+        `backend` chooses how the generated code is compiled, and
+        `cache_dir` is a directory to keep the compiled code in, so other
+        processes needn't compile it again.  See `CodeBuilder.get_globals`.
         """
         self.context = {}
         for context in contexts:
@@ -43,46 +122,185 @@ class Templite:
 
         self.all_vars = set()
         self.loop_vars = set()
+        self.all_dots = set()
+        self.all_calls = set()
+        # Names of the for loops being compiled, innermost last, and names
+        # that are used outside any loop that binds them.
+        self.bound_vars = []
+        self.free_vars = set()
         self.last_for = ""
-
-        code = CodeBuilder()
-
-        code.add_line("def render_function(context, do_dots):")
+        # The output, if it's the same for every rendering.
+        self._static_text = None
+
+        self._text = text
+        self._backend = backend
+        self._cache_dir = cache_dir
+        self._render_function = self._compile("return")
+        # The render functions for render_to and render_chunks, compiled the
+        # first time they're used.
+        self._render_to_function = None
+        self._render_chunks_function = None
+
+        if self._static_text is not None:
+            # Nothing to fill in, so rendering needn't run any code at all.
+            static_text = self._static_text
+            self.render = lambda context=None: static_text
+
+    @classmethod
+    def get_cached(cls, text, context=None):
+        """Get a compiled Templite for `text` and `context`, sharing it.
+
+        Templites made with the same text and context are compiled only
+        once, so this is cheaper than the constructor for templates that
+        are made again and again.  Values match if they're equal and of the
+        same type, checked inside tuples and frozensets too, so `1` and
+        `True`, or `0.0` and `-0.0`, don't share a Templite.  Other values
+        must be interchangeable when they're equal: `Decimal('1.0')` and
+        `Decimal('1.00')` would share one.  Unhashable values, like lists
+        and dicts, only match themselves.
+        """
+        key = ()
+        if context:
+            try:
+                # Names are unique, so the value keys aren't compared by the
+                # sort.
+                key = tuple(sorted(
+                    (name, _value_key(value)) for name, value in context.items()
+                ))
+            except TypeError:
+                # Names that can't be sorted.
+                return cls(text, context)
+        return _get_cached(cls, text, _CacheKey(key, context))
+
+    def _compile(self, mode):
+        """Compile the template, returning its render function.
+
+        `mode` is passed to `_generate`.
+        """
+        code = CodeBuilder.acquire()
+        try:
+            # Only exec'd code can be given values in its globals.
+            baked = self._generate(
+                code, self._text, bake=(self._backend == "python"), mode=mode,
+            )
+            namespace = {}
+            for name, value in baked.items():
+                namespace["_f_%s" % name] = value
+            namespace = code.get_globals(
+                self._backend, self._cache_dir, namespace=namespace,
+            )
+            return namespace['render_function']
+        finally:
+            # The builders are only needed while compiling.
+            code.release()
+
+    def _generate(self, code, text, bake=False, mode="return"):
+        """Write the Python source for the template `text` into `code`.
+
+        With `mode` "return", the function is `render_function(context,
+        do_dots)`, returning the output.  With "write", it's
+        `render_function(context, do_dots, append_result)`, calling
+        `append_result` with each piece of the output as it's made.  With
+        "yield", it's a generator function, `render_function(context,
+        do_dots)`, yielding the pieces.
+
+        If `bake` is true, callables from the constructor contexts that are
+        used as filters or functions aren't read from the render context.
+        They're the default values of extra parameters, taken from globals
+        named `_f_<name>` when the function is defined, so using them costs
+        no lookups at all.  Returns a dict of the callables to put in those
+        globals.
+        """
+        dots_code = code.add_section()
+        # The def line, written when the baked names are known.
+        def_code = code.add_section()
         code.indent()
         vars_code = code.add_section()
-        code.add_line("result = []")
-        code.add_line("append_result = result.append")
-        code.add_line("extend_result = result.extend")
-        code.add_line("to_str = str")
+        # The result list is only set up if the template needs one.
+        result_code = code.add_section()
 
         buffered = []
+        # The statement that outputs a piece.
+        if mode == "yield":
+            output_line = "yield %s"
+        else:
+            output_line = "append_result(%s)"
 
         def flush_output():
             """Force `buffered` to the code builder."""
-            if len(buffered) == 1:
-                code.add_line("append_result(%s)" % buffered[0])
-            elif len(buffered) > 1:
-                code.add_line("extend_result([%s])" % ", ".join(buffered))
+            if buffered:
+                setup, output = _output_code(buffered)
+                for line in setup:
+                    code.add_line(line)
+                code.add_line(output_line % output)
             del buffered[:]
 
-        ops_stack = []
-
-        tokens = re.split(r"(?s)({{.*?}}|{%.*?%}|{#.*?#})", text)
+        def open_loop(code, loop):
+            """Write the for statement, and any if, for a deferred loop."""
+            var_name, iter_code, cond_code = loop
+            code.add_line("for c_%s in %s:" % (var_name, iter_code))
+            code.indent()
+            if cond_code is not None:
+                code.add_line("if %s:" % cond_code)
+                code.indent()
+
+        def defer_comprehension(loop):
+            """Set aside a section for a deferred loop whose body is `buffered`.
+
+            Returns False, doing nothing, if the body can't be a single
+            f-string in a list comprehension, or if the loop's variable is
+            also an enclosing loop's: only a for statement leaves it set to
+            this loop's last value, as the rest of the outer body expects.
+            """
+            if loop[0] in self.bound_vars[:-1]:
+                return False
+            setup, output = _output_code(buffered)
+            if setup:
+                return False
+            comprehensions.append((code.add_section(), loop, output))
+            del buffered[:]
+            return True
 
-        for token in tokens:
-            if token.startswith('{#'):
+        ops_stack = []
+        # Until an action tag is seen, the output is a single expression.
+        straight_line = True
+        # For each open for loop: None, or if it's being unrolled, the
+        # enclosing code, the body section, the loop variable, the items, and
+        # if there's a condition, the length of the body's code with only it.
+        unrolled = []
+        # Names for the item values of unrolled loops.
+        item_names = []
+        # A for loop whose body has had no tags yet, so that it might still
+        # be written as a comprehension: (variable, iterable code, if code).
+        pending_loop = None
+        # Loops with only output in their bodies: (section, loop, output).
+        comprehensions = []
+
+        for kind, token in _tokenize(text):
+            if kind == 'comment':
                 # Comment: ignore it and move on.
                 continue
 
-            elif token.startswith('{{'):
+            elif kind == 'expr':
                 # An expression to evaluate.
                 expr = self._expr_code(token[2:-2].strip())
-                buffered.append("to_str(%s)" % expr)
+                buffered.append(('expr', expr))
 
-            elif token.startswith('{%'):
+            elif kind == 'tag':
                 # Action tag: split into words and parse further.
-                flush_output()
+                straight_line = False
                 words = token[2:-2].strip().split()
+                if pending_loop is not None:
+                    loop, pending_loop = pending_loop, None
+                    if words == ['endfor'] and (
+                        not buffered or defer_comprehension(loop)
+                    ):
+                        ops_stack.pop()
+                        unrolled.pop()
+                        self.bound_vars.pop()
+                        continue
+                    open_loop(code, loop)
+                flush_output()
 
                 if words[0] == 'if':
                     # An if statement: evaluate the expression to determine if.
@@ -124,25 +342,34 @@ class Templite:
                         if_pos = words.index('if')
                         expr = " ".join(words[3:if_pos])
                         cond_expr = " ".join(words[if_pos+1:])
-
-                        code.add_line(
-                            "for c_%s in %s:" % (
-                                words[1],
-                                self._expr_code(expr)
-                            )
-                        )
-                        code.indent()
-                        code.add_line("if %s:" % self._expr_code(cond_expr))
-                        code.indent()
                     else:
                         expr = " ".join(words[3:])
-                        code.add_line(
-                            "for c_%s in %s:" % (
-                                words[1],
-                                self._expr_code(expr)
-                            )
-                        )
-                        code.indent()
+                        cond_expr = None
+
+                    parser = ExpressionParser(expr, self)
+                    iter_code = parser.parse()
+                    self._note_free_vars(parser.names)
+                    items = parser.items
+                    self.bound_vars.append(words[1])
+                    cond_code = None
+                    if cond_expr is not None:
+                        cond_code = self._expr_code(cond_expr)
+                    if items is not None and len(items) <= self.UNROLL_LIMIT:
+                        # A short list display: write the body into its own
+                        # section, to be repeated once per item at endfor.
+                        body = CodeBuilder.acquire(code.indent_level)
+                        cond_length = None
+                        if cond_code is not None:
+                            body.add_line("if %s:" % cond_code)
+                            body.indent()
+                            cond_length = len(str(body))
+                        unrolled.append((code, body, words[1], items, cond_length))
+                        code = body
+                    else:
+                        # Wait for the body before writing anything: if it
+                        # is only output, the loop becomes a comprehension.
+                        unrolled.append(None)
+                        pending_loop = (words[1], iter_code, cond_code)
 
                 elif words[0].startswith('end'):
                     # Endsomething.  Pop the ops stack.
@@ -155,39 +382,133 @@ class Templite:
                     start_what = ops_stack.pop()
                     if start_what != end_what:
                         self._syntax_error("Mismatched end tag", end_what)
+                    if start_what == 'for':
+                        self.bound_vars.pop()
 
                     # Check if we are ending a conditional for loop
                     if start_what == 'for' and 'if' in self.last_for:
                         code.dedent()
+                    if start_what != 'for':
                         code.dedent()
-                    else:
+                    elif unrolled[-1] is None:
+                        unrolled.pop()
                         code.dedent()
+                    else:
+                        code, body, var_name, items, cond_length = unrolled.pop()
+                        if cond_length is not None and len(str(body)) == cond_length:
+                            # Nothing in the body: the if still needs a line.
+                            body.indent()
+                            body.add_line("pass")
+                            body.dedent()
+                        if items and not all(map(_is_literal, items)):
+                            # Work out every item before the first copy of
+                            # the body, as a for statement does.
+                            names = []
+                            for _ in items:
+                                names.append("_u%d" % len(item_names))
+                                item_names.append(names[-1])
+                            code.add_line("%s = %s" % (
+                                ", ".join(names), ", ".join(items),
+                            ))
+                            items = names
+                        for item in items:
+                            code.add_line("c_%s = %s" % (var_name, item))
+                            code.add_section(body)
 
                 else:
                     self._syntax_error("Don't understand tag", words[0])
 
             else:
-                # Literal content.  If it isn't empty, output it.
-                if token:
-                    buffered.append(repr(token))
+                # Literal content, never empty: output it.
+                buffered.append(('text', token))
 
         if ops_stack:
             self._syntax_error("Unmatched action tag", ops_stack[-1])
 
-        flush_output()
-
-        for var_name in self.all_vars - self.loop_vars:
-            vars_code.add_line("c_%s = context[%r]" % (var_name, var_name))
+        for section, loop, output in comprehensions:
+            var_name, iter_code, cond_code = loop
+            if var_name in self.free_vars or mode != "return":
+                # The variable is used outside the loop, and needs the value
+                # a for statement leaves behind, or the output is passed on
+                # as it's made, rather than built up in a list.
+                open_loop(section, loop)
+                section.add_line(output_line % output)
+            else:
+                cond = " if %s" % cond_code if cond_code is not None else ""
+                section.add_line("extend_result([%s for c_%s in %s%s])" % (
+                    output, var_name, iter_code, cond,
+                ))
+
+        if mode != "return":
+            flush_output()
+            if mode == "yield":
+                # Still a generator, even if the template has no output.
+                code.add_line("yield from ()")
+            else:
+                # The function needs a body, even if the template has no output.
+                code.add_line("pass")
+        elif straight_line:
+            # No control flow: return the output without building a list.
+            if all(kind == 'text' for kind, _ in buffered):
+                self._static_text = "".join(value for _, value in buffered)
+            setup, output = _output_code(buffered)
+            for line in setup:
+                code.add_line(line)
+            code.add_line("return %s" % output)
+        else:
+            flush_output()
+            result_code.add_line("result = []")
+            result_code.add_line("append_result = result.append")
+            result_code.add_line("extend_result = result.extend")
+            code.add_line("return ''.join(result)")
+
+        baked = {}
+        if bake:
+            for name in self.all_calls - self.loop_vars:
+                value = self.context.get(name)
+                if callable(value):
+                    baked[name] = value
+
+        params = ["context", "do_dots"]
+        if mode == "write":
+            params.append("append_result")
+        # Sorted, so the source is the same in every process.
+        for var_name in sorted(self.all_vars - self.loop_vars):
+            if var_name in baked:
+                params.append("c_%s=_f_%s" % (var_name, var_name))
+            else:
+                vars_code.add_line("c_%s = context[%r]" % (var_name, var_name))
+        def_code.add_line("def render_function(%s):" % ", ".join(params))
+
+        # Each attribute used with a dot gets its own copy of _do_dots.
+        for dot in sorted(self.all_dots):
+            dots_code.add_line("def _dot_%s(value):" % dot)
+            dots_code.indent()
+            dots_code.add_line("try:")
+            dots_code.add_line("    value = value.%s" % dot)
+            dots_code.add_line("except AttributeError:")
+            dots_code.add_line("    value = value[%r]" % dot)
+            dots_code.add_line("if callable(value):")
+            dots_code.add_line("    value = value()")
+            dots_code.add_line("return value")
+            dots_code.dedent()
 
-        code.add_line("return ''.join(result)")
         code.dedent()
-
-        self._render_function = code.get_globals()['render_function']
+        return baked
 
     def _expr_code(self, expr):
         """Generate a Python expression for `expr`."""
         parser = ExpressionParser(expr, self)
-        return parser.parse()
+        code = parser.parse()
+        self._note_free_vars(parser.names)
+        return code
+
+    def _note_free_vars(self, names):
+        """Record which of `names` aren't bound by an enclosing for loop."""
+        bound_vars = self.bound_vars
+        for name in names:
+            if name not in bound_vars:
+                self.free_vars.add(name)
 
     def _syntax_error(self, msg, thing):
         """Raise a syntax error using `msg`, and showing `thing`."""
@@ -200,7 +521,7 @@ class Templite:
 
         Raises an syntax error if `name` is not a valid name.
         """
-        if not re.match(r"[_a-zA-Z][_a-zA-Z0-9]*$", name):
+        if not _NAME_RE.match(name):
             self._syntax_error("Not a valid name", name)
         vars_set.add(name)
 
@@ -209,11 +530,63 @@ class Templite:
 
         `context` is a dictionary of values to use in this rendering.
         """
-        # Make the complete context we'll use.
+        return self._render_function(self._full_context(context), self._do_dots)
+
+    def render_many(self, contexts):
+        """Render this template once for each of `contexts`.
+
+        Returns a list of the results.  This is the same as calling `render`
+        for each context, with less overhead for each rendering.
+        """
+        render_function = self._render_function
+        do_dots = self._do_dots
+        full_context = self._full_context
+        results = []
+        append_result = results.append
+        for context in contexts:
+            append_result(render_function(full_context(context), do_dots))
+        return results
+
+    def render_chunks(self, context=None):
+        """Render this template by applying it to `context`, in pieces.
+
+        Returns an iterator of strings that join to make what `render`
+        would return.  Each piece is only made when it's asked for, so the
+        whole output is never in memory at once, and the pieces can be
+        passed on as they come, for example as a WSGI response.
+        """
+        render_chunks_function = self._render_chunks_function
+        if render_chunks_function is None:
+            render_chunks_function = self._render_chunks_function = (
+                self._compile("yield")
+            )
+        return render_chunks_function(self._full_context(context), self._do_dots)
+
+    def _full_context(self, context):
+        """Make the complete context to render with, given `context`.
+
+        The render function only reads the context, so if there's nothing
+        to merge, an existing dict is used as it is, without a copy.
+        """
+        if not context:
+            return self.context
+        if not self.context and type(context) is dict:
+            return context
         render_context = dict(self.context)
-        if context:
-            render_context.update(context)
-        return self._render_function(render_context, self._do_dots)
+        render_context.update(context)
+        return render_context
+
+    def render_to(self, stream, context=None):
+        """Render this template by applying it to `context`, into `stream`.
+
+        `stream` is any object with a `write` method, such as an open file.
+        The output is written in pieces as it's made, so it's never all in
+        memory at once.
+        """
+        render_to_function = self._render_to_function
+        if render_to_function is None:
+            render_to_function = self._render_to_function = self._compile("write")
+        render_to_function(self._full_context(context), self._do_dots, stream.write)
 
     def _do_dots(self, value, *dots):
         """Evaluate dotted expressions at runtime."""
@@ -225,3 +598,47 @@ class Templite:
             if callable(value):
                 value = value()
         return value
+
+
+def _value_key(value):
+    """Make the part of a get_cached key for the context value `value`."""
+    try:
+        hash(value)
+    except TypeError:
+        # The cached Templite keeps the value in its context, so the id
+        # can't be reused by another object while it's cached.
+        return ('id', id(value))
+    value_type = type(value)
+    if value_type is tuple:
+        return (tuple, tuple(map(_value_key, value)))
+    if value_type is frozenset:
+        return (frozenset, frozenset(map(_value_key, value)))
+    if value_type is float:
+        # 0.0 == -0.0, but they print differently.
+        return (float, value, math.copysign(1.0, value))
+    return (value_type, value)
+
+
+class _CacheKey:
+    """A get_cached key, with the context it was made from.
+
+    Only `key` is hashed and compared, so unhashable contexts can be cached.
+    """
+
+    __slots__ = ('key', 'context')
+
+    def __init__(self, key, context):
+        self.key = key
+        self.context = context
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+
+@functools.lru_cache(maxsize=512)
+def _get_cached(cls, text, cache_key):
+    """Compile and remember a Templite, for Templite.get_cached."""
+    return cls(text, cache_key.context or {})
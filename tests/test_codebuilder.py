@@ -4,9 +4,15 @@ import sys
 import os
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
 
+import importlib.util
+import tempfile
 import unittest
+from unittest import mock
+import codebuilder
 from codebuilder import CodeBuilder
 
+HAS_MYPYC = importlib.util.find_spec("mypyc") is not None
+
 
 class TestCodeBuilder(unittest.TestCase):
     """Test the CodeBuilder class."""
@@ -67,6 +73,12 @@ class TestCodeBuilder(unittest.TestCase):
         code.add_line("print('hello')")
         self.assertEqual(str(code), "        print('hello')\n")
 
+    def test_deep_indentation(self):
+        """Test indentation beyond the precomputed prefixes."""
+        code = CodeBuilder(indent=200)
+        code.add_line("x = 1")
+        self.assertEqual(str(code), " " * 200 + "x = 1\n")
+
     def test_section(self):
         """Test adding a section."""
         code = CodeBuilder()
@@ -98,6 +110,21 @@ class TestCodeBuilder(unittest.TestCase):
                    "    return result\n")
         self.assertEqual(str(code), expected)
 
+    def test_acquire_release(self):
+        """Test that released builders come back empty."""
+        code = CodeBuilder.acquire()
+        code.add_line("x = 1")
+        section = code.add_section()
+        section.add_line("y = 2")
+        code.add_section(section)
+        code.release()
+
+        reused = CodeBuilder.acquire(indent=4)
+        self.assertEqual(str(reused), "")
+        reused.add_line("z = 3")
+        self.assertEqual(str(reused), "    z = 3\n")
+        reused.release()
+
     def test_get_globals_simple(self):
         """Test executing simple code and getting globals."""
         code = CodeBuilder()
@@ -139,6 +166,151 @@ class TestCodeBuilder(unittest.TestCase):
         func = globals_dict['func']
         self.assertEqual(func(), 'from section')
 
+    def test_get_globals_namespace(self):
+        """Test running the code in globals that are already set up."""
+        code = CodeBuilder()
+        code.add_line("def func(x, f=_f):")
+        code.add_line("    return f(x)")
+
+        globals_dict = code.get_globals(namespace={'_f': str.upper})
+        self.assertEqual(globals_dict['func']('hi'), 'HI')
+
+    def test_get_globals_same_source(self):
+        """Test that identical source runs in fresh namespaces."""
+        first = CodeBuilder()
+        first.add_line("items = []")
+        second = CodeBuilder()
+        second.add_line("items = []")
+
+        first_globals = first.get_globals()
+        first_globals['items'].append(1)
+        second_globals = second.get_globals()
+        self.assertEqual(second_globals['items'], [])
+
+    def test_get_code(self):
+        """Test compiling the code to a reusable code object."""
+        code = CodeBuilder()
+        code.add_line("x = y * 2")
+
+        code_obj = code.get_code()
+        namespace = {'y': 21}
+        exec(code_obj, namespace)
+        self.assertEqual(namespace['x'], 42)
+        namespace = {'y': 5}
+        exec(code_obj, namespace)
+        self.assertEqual(namespace['x'], 10)
+
+    def test_get_code_cache_dir(self):
+        """Test that compiled code is kept in, and read from, cache_dir."""
+        code = CodeBuilder()
+        code.add_line("x = y + 1")
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            code.get_code(cache_dir=cache_dir)
+            cached = os.listdir(cache_dir)
+            self.assertEqual(len(cached), 1)
+            self.assertTrue(cached[0].endswith(".mpy"))
+
+            # A damaged file is replaced.
+            path = os.path.join(cache_dir, cached[0])
+            with open(path, "wb") as f:
+                f.write(b"junk")
+            codebuilder._load_cached_code.cache_clear()
+            namespace = {'y': 1}
+            exec(code.get_code(cache_dir=cache_dir), namespace)
+            self.assertEqual(namespace['x'], 2)
+
+            # The file is what's used when it's there.
+            codebuilder._load_cached_code.cache_clear()
+            namespace = {'y': 2}
+            exec(code.get_code(cache_dir=cache_dir), namespace)
+            self.assertEqual(namespace['x'], 3)
+            self.assertEqual(os.listdir(cache_dir), cached)
+
+    def test_get_code_cache_dir_not_writable(self):
+        """Test that a cache_dir that can't be written is ignored."""
+        code = CodeBuilder()
+        code.add_line("x = 17")
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            # A file where the directory should be.
+            not_a_dir = os.path.join(temp_dir, "file")
+            with open(not_a_dir, "w"):
+                pass
+            namespace = {}
+            exec(code.get_code(cache_dir=not_a_dir), namespace)
+            self.assertEqual(namespace['x'], 17)
+
+            # A directory where the cache file should be: the temporary
+            # file is cleaned up.
+            cache_dir = os.path.join(temp_dir, "cache")
+            code.get_code(cache_dir=cache_dir)
+            cached = os.listdir(cache_dir)
+            os.remove(os.path.join(cache_dir, cached[0]))
+            os.mkdir(os.path.join(cache_dir, cached[0]))
+            codebuilder._load_cached_code.cache_clear()
+            namespace = {}
+            exec(code.get_code(cache_dir=cache_dir), namespace)
+            self.assertEqual(namespace['x'], 17)
+            self.assertEqual(os.listdir(cache_dir), cached)
+
+    def test_get_globals_unknown_backend(self):
+        """Test that get_globals rejects backends it doesn't know."""
+        code = CodeBuilder()
+        code.add_line("x = 1")
+
+        with self.assertRaises(ValueError):
+            code.get_globals(backend="numba")
+
+    @unittest.skipUnless(HAS_MYPYC, "mypyc is not installed")
+    def test_get_globals_mypyc(self):
+        """Test compiling with mypyc, outside the current directory."""
+        code = CodeBuilder()
+        code.add_line("def double(x):")
+        code.add_line("    return x * 2")
+
+        old_cache_dir = codebuilder.MYPYC_CACHE_DIR
+        old_cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as cache_dir, \
+                tempfile.TemporaryDirectory() as work_dir:
+            codebuilder.MYPYC_CACHE_DIR = cache_dir
+            os.chdir(work_dir)
+            try:
+                # Changing directory would affect every thread.
+                with mock.patch("os.chdir", side_effect=AssertionError):
+                    globals_dict = code.get_globals(backend="mypyc")
+                self.assertEqual(os.listdir(work_dir), [])
+            finally:
+                os.chdir(old_cwd)
+                codebuilder.MYPYC_CACHE_DIR = old_cache_dir
+        self.assertEqual(globals_dict['double'](21), 42)
+
+    def test_get_globals_shares_string_constants(self):
+        """Test that equal strings in different code are one object."""
+        text = "".join(["shared ", "text"])
+        first = CodeBuilder()
+        first.add_line("def f():")
+        first.add_line("    return %r" % text)
+        second = CodeBuilder()
+        second.add_line("def g():")
+        second.add_line("    return [%r]" % text)
+
+        f = first.get_globals()['f']
+        g = second.get_globals()['g']
+        self.assertEqual(f(), text)
+        if sys.version_info >= (3, 8):
+            self.assertIs(f(), g()[0])
+
+    def test_get_globals_long_string_constants(self):
+        """Test that long strings aren't kept in the shared constants."""
+        text = "x" * (codebuilder._CONSTANTS_MAX_LEN + 1)
+        code = CodeBuilder()
+        code.add_line("def f():")
+        code.add_line("    return %r" % text)
+
+        self.assertEqual(code.get_globals()['f'](), text)
+        self.assertNotIn(text, codebuilder._CONSTANTS)
+
     def test_get_globals_indent_check(self):
         """Test that get_globals checks for proper indentation."""
         code = CodeBuilder()
@@ -147,7 +319,7 @@ class TestCodeBuilder(unittest.TestCase):
         code.add_line("return True")
         # Forgot to dedent
         
-        with self.assertRaises(AssertionError):
+        with self.assertRaises(RuntimeError):
             code.get_globals()
 
 
@@ -1,7 +1,10 @@
 """Comprehensive test suite for the Templite template engine."""
 
+import io
 import sys
 import os
+import subprocess
+import tempfile
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
 
 import unittest
@@ -21,6 +24,13 @@ class TestTemplite(unittest.TestCase):
         t = Templite("Hello, World!")
         self.assertEqual(t.render(), "Hello, World!")
 
+    def test_static_template_ignores_context(self):
+        """Test that a template with no tags renders the same for any context."""
+        t = Templite("Hello, {# nobody #}World!", {'x': 1})
+        self.assertEqual(t.render(), "Hello, World!")
+        self.assertEqual(t.render({'name': 'Ned'}), "Hello, World!")
+        self.assertEqual(t.render_many([None, {}]), ["Hello, World!"] * 2)
+
     def test_simple_variable(self):
         """Test a simple variable substitution."""
         t = Templite("Hello, {{name}}!")
@@ -65,6 +75,9 @@ class TestTemplite(unittest.TestCase):
         """Test dictionary access with dots."""
         t = Templite("{{data.key}}")
         self.assertEqual(t.render({'data': {'key': 'value'}}), "value")
+        # Keys that aren't valid attribute names work too.
+        t = Templite("{{data.class}}")
+        self.assertEqual(t.render({'data': {'class': 'first'}}), "first")
 
     def test_chained_dots(self):
         """Test chained dot access."""
@@ -292,6 +305,124 @@ class TestTemplite(unittest.TestCase):
         t = Templite("{{value}}", {'value': 'constructor'})
         self.assertEqual(t.render({'value': 'render'}), "render")
 
+    def test_constructor_filters_are_bound(self):
+        """Test that constructor filters are fixed when compiling."""
+        t = Templite("{{name|shout}} {{ greet(name) }}", {
+            'shout': str.upper,
+            'greet': "Hi {}".format,
+        })
+        self.assertEqual(t.render({'name': 'ned'}), "NED Hi ned")
+        context = {'name': 'ned', 'shout': str.lower}
+        self.assertEqual(t.render(context), "NED Hi ned")
+
+    def test_get_cached(self):
+        """Test sharing compiled templates."""
+        t1 = Templite.get_cached("{{name|upper}}", {'upper': str.upper})
+        t2 = Templite.get_cached("{{name|upper}}", {'upper': str.upper})
+        self.assertIs(t1, t2)
+        self.assertEqual(t1.render({'name': 'ned'}), "NED")
+        t3 = Templite.get_cached("{{name|upper}}", {'upper': str.lower})
+        self.assertIsNot(t1, t3)
+        self.assertEqual(t3.render({'name': 'NED'}), "ned")
+
+    def test_get_cached_equal_values_of_other_types(self):
+        """Test that get_cached tells apart equal values of different types."""
+        self.assertEqual(Templite.get_cached("{{x}}", {'x': True}).render(), "True")
+        self.assertEqual(Templite.get_cached("{{x}}", {'x': 1}).render(), "1")
+        self.assertEqual(Templite.get_cached("{{x}}", {'x': 1.0}).render(), "1.0")
+        self.assertEqual(Templite.get_cached("{{x}}", {'x': 0.0}).render(), "0.0")
+        self.assertEqual(Templite.get_cached("{{x}}", {'x': -0.0}).render(), "-0.0")
+        self.assertEqual(Templite.get_cached("{{x}}", {'x': (1,)}).render(), "(1,)")
+        self.assertEqual(
+            Templite.get_cached("{{x}}", {'x': (True,)}).render(), "(True,)"
+        )
+
+    def test_get_cached_unhashable_context(self):
+        """Test get_cached with context values that can't be hashed."""
+        user = {'name': 'Ned'}
+        t = Templite.get_cached("{{user.name}}", {'user': user})
+        self.assertEqual(t.render(), "Ned")
+        # The same object shares the Templite, an equal one doesn't.
+        self.assertIs(Templite.get_cached("{{user.name}}", {'user': user}), t)
+        other = Templite.get_cached("{{user.name}}", {'user': dict(user)})
+        self.assertIsNot(other, t)
+        self.assertEqual(other.render(), "Ned")
+
+    def test_cache_dir(self):
+        """Test templates compiled with a cache directory."""
+        text = "{% for n in names %}{{n|upper}} {% endfor %}{{title}}"
+        with tempfile.TemporaryDirectory() as cache_dir:
+            first = Templite(text, {'upper': str.upper}, cache_dir=cache_dir)
+            second = Templite(text, {'upper': str.lower}, cache_dir=cache_dir)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+        context = {'names': ['Ned', 'Ada'], 'title': 'Names'}
+        self.assertEqual(first.render(context), "NED ADA Names")
+        self.assertEqual(second.render(context), "ned ada Names")
+
+    def test_cache_dir_across_processes(self):
+        """Test that processes with different hash seeds share cached code."""
+        src_dir = os.path.join(os.path.dirname(__file__), '..', 'src')
+        script = (
+            "import sys; sys.path.insert(0, sys.argv[1]);"
+            "from templite import Templite;"
+            "t = Templite('{{a}}{{b}}{{c}}{{d}}', cache_dir=sys.argv[2]);"
+            "print(t.render({'a': 1, 'b': 2, 'c': 3, 'd': 4}))"
+        )
+        with tempfile.TemporaryDirectory() as cache_dir:
+            for seed in "1234":
+                env = dict(os.environ, PYTHONHASHSEED=seed)
+                output = subprocess.check_output(
+                    [sys.executable, "-c", script, src_dir, cache_dir],
+                    env=env, universal_newlines=True,
+                )
+                self.assertEqual(output.strip(), "1234")
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+    def test_render_many(self):
+        """Test rendering with several contexts at once."""
+        t = Templite("{{greeting}}, {{name}}!", {'greeting': 'Hello'})
+        results = t.render_many([{'name': 'Ned'}, {'name': 'Ada'}])
+        self.assertEqual(results, ["Hello, Ned!", "Hello, Ada!"])
+        results = t.render_many({'greeting': 'Hi', 'name': n} for n in "ab")
+        self.assertEqual(results, ["Hi, a!", "Hi, b!"])
+        self.assertEqual(t.render_many([]), [])
+
+    def test_render_to(self):
+        """Test rendering into a stream."""
+        t = Templite("Hello, {{name}}!")
+        out = io.StringIO()
+        t.render_to(out, {'name': 'World'})
+        self.assertEqual(out.getvalue(), "Hello, World!")
+        for text in ["", "{# nothing #}"]:
+            out = io.StringIO()
+            Templite(text).render_to(out)
+            self.assertEqual(out.getvalue(), "")
+
+    def test_render_to_writes_pieces(self):
+        """Test that render_to writes the output as it's made."""
+        t = Templite(
+            "{% for n in names %}{{n|upper}} {% endfor %}{% if end %}!{% endif %}",
+            {'upper': str.upper},
+        )
+        pieces = []
+
+        class Stream:
+            write = staticmethod(pieces.append)
+
+        context = {'names': ['a', 'b'], 'end': True}
+        t.render_to(Stream(), context)
+        self.assertEqual(pieces, ["A ", "B ", "!"])
+        self.assertEqual("".join(pieces), t.render(context))
+
+    def test_render_chunks(self):
+        """Test rendering as an iterator of pieces."""
+        t = Templite("{% for n in names %}{{n}}, {% endfor %}{{last}}")
+        context = {'names': ['a', 'b'], 'last': 'c'}
+        self.assertEqual(list(t.render_chunks(context)), ["a, ", "b, ", "c"])
+        self.assertEqual("".join(t.render_chunks(context)), t.render(context))
+        t = Templite("{% if show %}shown{% endif %}")
+        self.assertEqual(list(t.render_chunks({'show': False})), [])
+
     def test_whitespace_handling(self):
         """Test various whitespace scenarios."""
         # Test that whitespace in expressions is handled
@@ -389,6 +520,19 @@ class TestTemplite(unittest.TestCase):
         t = Templite("{{ (5 + 3) * 2 }}")
         self.assertEqual(t.render(), "16")
 
+    def test_constant_expressions(self):
+        """Test expressions made only of literals."""
+        t = Templite('{{ "tag" + "-" + "foo" }}')
+        self.assertEqual(t.render(), "tag-foo")
+        t = Templite('{% if not "" %}yes{% endif %}')
+        self.assertEqual(t.render(), "yes")
+        t = Templite("{{ 2 * 3 + x }}")
+        self.assertEqual(t.render({'x': 1}), "7")
+        # Errors still happen when rendering, not when compiling.
+        t = Templite("{{ 1 / 0 }}")
+        with self.assertRaises(ZeroDivisionError):
+            t.render()
+
     def test_comparison_operators(self):
         """Test comparison operators."""
         t = Templite("{% if 5 > 3 %}yes{% endif %}")
@@ -465,5 +609,89 @@ class TestTemplite(unittest.TestCase):
         context = {'products': products}
         self.assertEqual(t.render(context), "cheap affordable ")
 
+    def test_loop_attributes_evaluated_each_time(self):
+        """Test that attributes in a loop body are looked up every iteration."""
+        class Counter:
+            def __init__(self):
+                self.count = 0
+
+            def next(self):
+                self.count += 1
+                return self.count
+
+        t = Templite("{% for i in items %}{{c.next}},{% endfor %}")
+        context = {'items': [1, 2, 3], 'c': Counter()}
+        self.assertEqual(t.render(context), "1,2,3,")
+        context['c'] = Counter()
+        self.assertEqual("".join(t.render_chunks(context)), "1,2,3,")
+
+        # State changed by the loop's own iterable is seen too.
+        state = Counter()
+
+        def bump(n):
+            for i in range(n):
+                state.count += 1
+                yield i
+
+        t = Templite("{% for i in items %}{{s.count}} {% endfor %}")
+        self.assertEqual(t.render({'items': bump(3), 's': state}), "1 2 3 ")
+
+    def test_for_loop_variable_after_loop(self):
+        """Test that a loop variable keeps its last value after the loop."""
+        t = Templite("{% for x in xs %}{{x}},{% endfor %}last={{x}}")
+        self.assertEqual(t.render({'xs': [1, 2, 3]}), "1,2,3,last=3")
+        t = Templite(
+            "{% for x in xs %}{{x}}{% endfor %}"
+            "{% for x in ys %}{{x}}{% endfor %}"
+        )
+        self.assertEqual(t.render({'xs': "ab", 'ys': "cd"}), "abcd")
+
+    def test_nested_loop_reusing_variable(self):
+        """Test an inner loop that rebinds the outer loop's variable."""
+        class Node:
+            def __init__(self, kids):
+                self.kids = kids
+
+        xs = [Node([1, 2]), Node([3])]
+        t = Templite(
+            "{% for x in xs %}{% for x in x.kids %}{{x}}{% endfor %}"
+            "[{{x}}]{% endfor %}"
+        )
+        self.assertEqual(t.render({'xs': xs}), "12[2]3[3]")
+
+    def test_for_loop_over_list_display(self):
+        """Test for loops over a list written in the template."""
+        t = Templite('{% for x in ["a", 2, y] %}<{{x}}>{% endfor %}')
+        self.assertEqual(t.render({'y': 'z'}), "<a><2><z>")
+        t = Templite("{% for x in [1, 2, 3] if x > 1 %}{{x}}{% endfor %}")
+        self.assertEqual(t.render(), "23")
+        t = Templite(
+            "{% for x in [1, 2] %}{% for y in [x, 3] %}{{x}}{{y}} "
+            "{% endfor %}{% endfor %}"
+        )
+        self.assertEqual(t.render(), "11 13 22 23 ")
+        t = Templite("{% for x in [] %}{{x}}{% endfor %}!")
+        self.assertEqual(t.render(), "!")
+
+    def test_for_loop_over_list_display_items_first(self):
+        """Test that a list display's items are worked out before the body."""
+        t = Templite(
+            '{% for x in xs %}{% for x in ["b", x] %}{{x}}{% endfor %}'
+            '{% endfor %}'
+        )
+        self.assertEqual(t.render({'xs': ["a"]}), "ba")
+
+    def test_for_loop_over_list_display_empty_body(self):
+        """Test a conditional loop over a list display with an empty body."""
+        t = Templite("{% for a in [x, y] if c %}{% endfor %}done")
+        self.assertEqual(t.render({'x': 1, 'y': 2, 'c': True}), "done")
+
+    def test_for_loop_over_long_list_display(self):
+        """Test for loops over lists too long to unroll."""
+        numbers = ", ".join(str(n) for n in range(Templite.UNROLL_LIMIT + 1))
+        t = Templite("{% for n in [" + numbers + "] %}{{n}};{% endfor %}")
+        expected = "".join("%d;" % n for n in range(Templite.UNROLL_LIMIT + 1))
+        self.assertEqual(t.render(), expected)
+
 if __name__ == '__main__':
     unittest.main()